@@ -5,7 +5,7 @@ Features:
 - User login (per-user JSON persistence)
 - CSV import for medicines
 - Next-dose card + countdown
-- Weekly adherence chart (last 14 days) using matplotlib
+- Weekly adherence chart (last 14 days) using Altair
 - Missed-dose notification + 'Send reminder' simulation
 - Safe generated plant image if no external logo provided
 """
@@ -17,9 +17,19 @@ import json
 from pathlib import Path
 from PIL import Image, ImageDraw
 import io
+import os
+import stat
+import uuid
 import base64
-import matplotlib.pyplot as plt
+import altair as alt
 import urllib.parse
+import re
+import bisect
+
+try:
+    import orjson
+except ImportError:  # fall back to stdlib json if the orjson wheel is missing
+    orjson = None
 
 # -------------------------
 # CONFIG / THEME
@@ -27,6 +37,7 @@ import urllib.parse
 DEFAULT_DATA_FILE = Path("adhera_data.json")
 PAGE_TITLE = "Adhera — Your Daily Health Companion"
 PAGE_ICON = "🌿"
+_HHMM_RE = re.compile(r"^([01]\d|2[0-3]):[0-5]\d$")  # 24h "HH:MM"
 
 # ALL GREEN/ACCENT -> WHITE
 ACCENT = "#FFFFFF"
@@ -86,40 +97,201 @@ def get_data_file():
         return st.session_state.user_file
     return DEFAULT_DATA_FILE
 
+# -------------------------
+# Small utility helpers
+# -------------------------
+def safe_rerun():
+    if hasattr(st, "experimental_rerun"):
+        try:
+            st.experimental_rerun()
+        except Exception:
+            pass
+    elif hasattr(st, "rerun"):
+        try:
+            st.rerun()
+        except Exception:
+            pass
+
+def _fragment(func):
+    """Run func as an st.fragment (reruns on its own) when this Streamlit version supports it."""
+    frag = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+    return frag(func) if frag else func
+
+def sched_minutes(hhmm: str):
+    """Minutes after midnight for an 'HH:MM' string, or None if it cannot be parsed."""
+    try:
+        hh, mm = map(int, hhmm.split(":"))
+    except Exception:
+        return None
+    if not (0 <= hh < 24 and 0 <= mm < 60):
+        return None
+    return hh * 60 + mm
+
+def friendly_time_str(hhmm: str) -> str:
+    try:
+        dt = datetime.strptime(hhmm, "%H:%M")
+        return dt.strftime("%I:%M %p").lstrip("0")
+    except Exception:
+        return hhmm
+
 # -------------------------
 # Persistence (load/save)
 # -------------------------
+def _json_loads(raw: bytes):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw.decode("utf-8"))
+
+def _json_dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+
+def _json_line(rec) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(rec) + b"\n"
+    return json.dumps(rec, ensure_ascii=False).encode("utf-8") + b"\n"
+
+def _write_atomic(path, payload: bytes):
+    """Write payload to a temp file and rename it over path, so readers never see a half-written file.
+
+    The temp file name is unique per call: sessions run as threads in one process and
+    anonymous users share the default data file. It is created with mode 0o666 so the
+    umask applies as for a plain open(); an existing target keeps its own mode.
+    """
+    tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        if path.exists():
+            os.chmod(tmp, stat.S_IMODE(path.stat().st_mode))
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def get_history_file():
+    """Return the append-only history log (JSONL) that sits next to the user's data file."""
+    DATA_FILE = get_data_file()
+    return DATA_FILE.with_name(DATA_FILE.stem + "_history.jsonl")
+
+def load_history_from_disk(legacy=None):
+    """Replay the history log; later records for the same (date, name, sched_time) win."""
+    records = {}
+    for h in legacy or []:
+        records[(h["date"], h["name"], h["sched_time"])] = h
+    HISTORY_FILE = get_history_file()
+    if HISTORY_FILE.exists():
+        with open(HISTORY_FILE, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    h = _json_loads(line)
+                    key = (h["date"], h["name"], h["sched_time"])
+                except Exception:
+                    continue  # torn or malformed record; skip it rather than drop all state
+                records[key] = h
+    return list(records.values())
+
+def rebuild_history_index():
+    """Index history records by (date, name, sched_time) for O(1) lookups."""
+    st.session_state.history_index = {(h["date"], h["name"], h["sched_time"]): h for h in st.session_state.history}
+
+def _med_key(med):
+    """Sort key for medicines; unparsable times (sched_mins None) sort last."""
+    return (1440 if med["sched_mins"] is None else med["sched_mins"], med["id"])
+
+def rebuild_med_keys():
+    """Rebuild the schedule-sorted (sched_mins, id) key list and the id -> medicine lookup.
+
+    st.session_state.medicines itself stays in the order medicines were added.
+    """
+    st.session_state.med_keys = sorted(_med_key(m) for m in st.session_state.medicines)
+    st.session_state.med_by_id = {m["id"]: m for m in st.session_state.medicines}
+
+def medicines_by_schedule():
+    """Medicines in schedule order, read through med_keys without sorting."""
+    return [st.session_state.med_by_id[med_id] for _, med_id in st.session_state.med_keys]
+
+def _set_state(medicines, history, next_id):
+    """Assign loaded values, leaving session_state keys alone when they already match."""
+    for key, value in (("medicines", medicines), ("history", history), ("next_id", next_id)):
+        if st.session_state.get(key) != value:
+            st.session_state[key] = value
+    rebuild_med_keys()
+    rebuild_history_index()
+    _bump_history_version()
+
 def load_state_from_disk():
     DATA_FILE = get_data_file()
     if DATA_FILE.exists():
         try:
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            st.session_state.medicines = data.get("medicines", [])
-            st.session_state.history = data.get("history", [])
-            st.session_state.next_id = data.get("next_id", 1)
+            with open(DATA_FILE, "rb") as f:
+                data = _json_loads(f.read())
+            legacy_history = data.get("history", [])
+            medicines = data.get("medicines", [])
+            for med in medicines:
+                # files written before sched_mins was stored
+                med.setdefault("sched_mins", sched_minutes(med.get("sched_time", "")))
+            _set_state(medicines, load_history_from_disk(legacy_history), data.get("next_id", 1))
+            if legacy_history:
+                # older files kept history inline; move it into the log once, and only
+                # strip it from the data file after the log was written successfully
+                if save_history_to_disk():
+                    save_state_to_disk()
         except Exception:
-            st.session_state.medicines = []
-            st.session_state.history = []
-            st.session_state.next_id = 1
+            _set_state([], [], 1)
     else:
-        st.session_state.medicines = []
-        st.session_state.history = []
-        st.session_state.next_id = 1
+        _set_state([], [], 1)
+
+def _bump_history_version():
+    """Invalidate the per-session history views (see _history_views) after any change."""
+    st.session_state.history_version = st.session_state.get("history_version", 0) + 1
 
 def save_state_to_disk():
+    """Rewrite the medicines file. History is persisted separately via history_append."""
     DATA_FILE = get_data_file()
     data = {
         "medicines": st.session_state.medicines,
-        "history": st.session_state.history,
         "next_id": st.session_state.next_id
     }
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        _write_atomic(DATA_FILE, _json_dumps(data))
     except Exception as e:
         st.error(f"Could not save data: {e}")
 
+def history_append(rec):
+    _bump_history_version()
+    try:
+        with open(get_history_file(), "a+b") as f:
+            f.seek(0, os.SEEK_END)
+            prefix = b""
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    prefix = b"\n"  # previous write was cut off mid-record; start a fresh line
+            f.write(prefix + _json_line(rec))
+    except Exception as e:
+        st.error(f"Could not save history: {e}")
+
+def save_history_to_disk() -> bool:
+    """Rewrite the whole history log (used when records are removed, not for marking doses).
+
+    Returns True if the log was written.
+    """
+    _bump_history_version()
+    try:
+        _write_atomic(get_history_file(), b"".join(_json_line(h) for h in st.session_state.history))
+        return True
+    except Exception as e:
+        st.error(f"Could not save history: {e}")
+        return False
+
 # -------------------------
 # Session init
 # -------------------------
@@ -127,104 +299,158 @@ if "initialized" not in st.session_state:
     # prepare defaults until user logs in (login may override file)
     st.session_state.medicines = []
     st.session_state.history = []
+    st.session_state.history_index = {}
+    st.session_state.med_keys = []
+    st.session_state.med_by_id = {}
     st.session_state.next_id = 1
+    st.session_state.history_version = 0
     st.session_state.user = None
     st.session_state.user_file = None
     st.session_state.initialized = True
     # attempt to load default file so app shows existing data if present
     if DEFAULT_DATA_FILE.exists():
         load_state_from_disk()
-
-# -------------------------
-# Small utility helpers
-# -------------------------
-def safe_rerun():
-    if hasattr(st, "experimental_rerun"):
-        try:
-            st.experimental_rerun()
-        except Exception:
-            pass
-    elif hasattr(st, "rerun"):
-        try:
-            st.rerun()
-        except Exception:
-            pass
-
-def friendly_time_str(hhmm: str) -> str:
-    try:
-        dt = datetime.strptime(hhmm, "%H:%M")
-        return dt.strftime("%I:%M %p").lstrip("0")
-    except Exception:
-        return hhmm
+if "history_index" not in st.session_state:
+    rebuild_history_index()
+if "med_keys" not in st.session_state or "med_by_id" not in st.session_state:
+    rebuild_med_keys()
 
 # -------------------------
 # Core actions: add/delete/mark
 # -------------------------
-def add_medicine(name: str, sched_time_str: str, notes: str = ""):
-    med = {"id": st.session_state.next_id, "name": name.strip(), "sched_time": sched_time_str, "notes": notes.strip()}
+def _add_medicine_nosave(name: str, sched_time_str: str, notes: str = "", keep_sorted: bool = True):
+    """Add a medicine in memory only; callers adding many at once save once afterwards.
+
+    Bulk callers pass keep_sorted=False and call rebuild_med_keys() once at the end.
+    """
+    med = {"id": st.session_state.next_id, "name": name.strip(), "sched_time": sched_time_str,
+           "sched_mins": sched_minutes(sched_time_str), "notes": notes.strip()}
     st.session_state.next_id += 1
     st.session_state.medicines.append(med)
+    if keep_sorted:
+        # keep the schedule index sorted so the checklist never has to sort
+        bisect.insort(st.session_state.med_keys, _med_key(med))
+        st.session_state.med_by_id[med["id"]] = med
+    return med
+
+def add_medicine(name: str, sched_time_str: str, notes: str = ""):
+    med = _add_medicine_nosave(name, sched_time_str, notes)
     save_state_to_disk()
+    return med
 
 def delete_medicine(med_id: int):
     st.session_state.medicines = [m for m in st.session_state.medicines if m["id"] != med_id]
+    st.session_state.med_keys = [k for k in st.session_state.med_keys if k[1] != med_id]
+    st.session_state.med_by_id.pop(med_id, None)
     save_state_to_disk()
 
-def mark_taken(name: str, sched_time_str: str):
+def mark_taken(name: str, sched_time_str: str) -> bool:
+    """Record a dose as taken. Returns True only if the history actually changed."""
     today = date.today().isoformat()
     now_str = datetime.now().strftime("%H:%M")
-    existing = next((h for h in st.session_state.history if h["date"] == today and h["name"] == name and h["sched_time"] == sched_time_str), None)
+    existing = st.session_state.history_index.get((today, name, sched_time_str))
     if existing:
+        if existing["taken"] and existing["taken_time"] == now_str:
+            return False
         existing["taken"] = True
         existing["taken_time"] = now_str
     else:
-        st.session_state.history.append({"date": today, "name": name, "sched_time": sched_time_str, "taken": True, "taken_time": now_str})
-    save_state_to_disk()
-
-def mark_missed(name: str, sched_time_str: str):
+        existing = {"date": today, "name": name, "sched_time": sched_time_str, "taken": True, "taken_time": now_str}
+        st.session_state.history.append(existing)
+        st.session_state.history_index[(today, name, sched_time_str)] = existing
+    history_append(existing)
+    return True
+
+def mark_missed(name: str, sched_time_str: str) -> bool:
+    """Record a dose as missed unless it already has a record. Returns True if the history changed."""
     today = date.today().isoformat()
-    existing = next((h for h in st.session_state.history if h["date"] == today and h["name"] == name and h["sched_time"] == sched_time_str), None)
-    if not existing:
-        st.session_state.history.append({"date": today, "name": name, "sched_time": sched_time_str, "taken": False, "taken_time": ""})
-    save_state_to_disk()
+    existing = st.session_state.history_index.get((today, name, sched_time_str))
+    if existing:
+        return False
+    rec = {"date": today, "name": name, "sched_time": sched_time_str, "taken": False, "taken_time": ""}
+    st.session_state.history.append(rec)
+    st.session_state.history_index[(today, name, sched_time_str)] = rec
+    history_append(rec)
+    return True
 
 # -------------------------
 # Chart helpers (visual analytics)
 # -------------------------
+HISTORY_COLUMNS = ["date", "name", "sched_time", "taken", "taken_time"]
+
+def _history_views():
+    """Per-session views derived from the history, dropped whenever history_version changes."""
+    version = st.session_state.get("history_version", 0)
+    views = st.session_state.get("history_views")
+    if views is None or views["version"] != version:
+        views = {"version": version}
+        st.session_state.history_views = views
+    return views
+
+def history_frame():
+    """Columnar view of the history (date as datetime64, taken as bool).
+
+    st.session_state.history stays the source of truth; this is the one DataFrame built
+    from it, shared by analytics, the history table and the CSV export.
+    """
+    views = _history_views()
+    if "frame" not in views:
+        df = pd.DataFrame(st.session_state.history, columns=HISTORY_COLUMNS)
+        df["date"] = pd.to_datetime(df["date"], format="%Y-%m-%d")
+        df["taken"] = df["taken"].astype(bool)
+        views["frame"] = df
+    return views["frame"]
+
 def daily_adherence_series(days_back=14):
     today = date.today()
     dates = [today - timedelta(days=i) for i in range(days_back-1, -1, -1)]
-    rows = []
-    for d in dates:
-        dstr = d.isoformat()
-        scheduled_count = len(st.session_state.medicines) if st.session_state.medicines else 0
-        if scheduled_count == 0:
-            rows.append((d, 100.0))
-            continue
-        records = [h for h in st.session_state.history if h["date"] == dstr]
-        taken_count = 0
-        for s in st.session_state.medicines:
-            found = any(r["name"] == s["name"] and r["sched_time"] == s["sched_time"] and r["taken"] for r in records)
-            if found:
-                taken_count += 1
-        pct = (taken_count / scheduled_count) * 100
-        rows.append((d, pct))
-    df = pd.DataFrame(rows, columns=["date", "adherence"]).set_index("date")
-    return df["adherence"]
+    meds = st.session_state.medicines
+    if not meds:
+        return pd.Series(100.0, index=pd.Index(dates, name="date"), name="adherence")
+    days = pd.DatetimeIndex(dates)
+    hist = history_frame()
+    hist = hist[hist["taken"] & hist["date"].between(days[0], days[-1])]
+    # one row per (day, scheduled medicine) that has a taken record
+    scheduled = pd.DataFrame([(m["name"], m["sched_time"]) for m in meds], columns=["name", "sched_time"])
+    taken = hist.drop_duplicates(["date", "name", "sched_time"]).merge(scheduled, on=["name", "sched_time"])
+    taken_per_day = taken.groupby("date").size().reindex(days, fill_value=0)
+    ser = taken_per_day.astype(float) / len(meds) * 100
+    ser.index = pd.Index(dates, name="date")
+    ser.name = "adherence"
+    return ser
 
 def show_adherence_chart():
     ser = daily_adherence_series(days_back=14)
     if ser.empty:
         st.info("No adherence data to show.")
         return
-    fig, ax = plt.subplots(figsize=(5,2.4))
-    ax.plot(ser.index, ser.values, marker="o", linewidth=2)
-    ax.set_ylim(0,100)
-    ax.set_ylabel("Adherence %")
-    ax.set_title("Last 14 days — Adherence")
-    plt.xticks(rotation=45, ha="right")
-    plt.tight_layout()
-    st.pyplot(fig)
+    df = ser.reset_index()
+    df["date"] = pd.to_datetime(df["date"])
+    # rendered client-side from a small Vega-Lite spec, no server-side rasterizing
+    chart = alt.Chart(df, title="Last 14 days — Adherence").mark_line(point=True).encode(
+        x=alt.X("date:T", title=None),
+        y=alt.Y("adherence:Q", title="Adherence %", scale=alt.Scale(domain=[0, 100])),
+    )
+    st.altair_chart(chart, use_container_width=True)
+
+# -------------------------
+# History table helpers
+# -------------------------
+def history_table():
+    """History for display, most recent first, with dates back in YYYY-MM-DD form."""
+    views = _history_views()
+    if "table" not in views:
+        df = history_frame().sort_values(["date", "sched_time"], ascending=False, ignore_index=True)
+        df["date"] = df["date"].dt.strftime("%Y-%m-%d")
+        views["table"] = df
+    return views["table"]
+
+def history_csv() -> bytes:
+    """CSV export of the history, encoded once per history change."""
+    views = _history_views()
+    if "csv" not in views:
+        views["csv"] = history_table().to_csv(index=False).encode("utf-8")
+    return views["csv"]
 
 # -------------------------
 # Next-dose helpers
@@ -232,21 +458,16 @@ def show_adherence_chart():
 def next_scheduled_dose(now=None):
     if now is None:
         now = datetime.now()
-    upcoming = []
-    for med in st.session_state.medicines:
-        try:
-            hh, mm = map(int, med["sched_time"].split(":"))
-        except Exception:
-            continue
-        today_dt = datetime.combine(date.today(), datetime.min.time()) + timedelta(hours=hh, minutes=mm)
-        if today_dt >= now:
-            upcoming.append((today_dt, med))
-        else:
-            upcoming.append((today_dt + timedelta(days=1), med))
-    if not upcoming:
+    scheduled = [m for m in st.session_state.medicines if m["sched_mins"] is not None]
+    if not scheduled:
         return None, None
-    upcoming.sort(key=lambda x: x[0])
-    return upcoming[0][1], upcoming[0][0]
+    now_mins = now.hour * 60 + now.minute
+    # minutes until each dose, wrapping past midnight to tomorrow
+    med = min(scheduled, key=lambda m: (m["sched_mins"] - now_mins) % 1440)
+    dt = datetime.combine(now.date(), time()) + timedelta(minutes=med["sched_mins"])
+    if med["sched_mins"] < now_mins:
+        dt += timedelta(days=1)
+    return med, dt
 
 def human_delta(dt):
     now = datetime.now()
@@ -271,18 +492,15 @@ def human_delta(dt):
 def check_and_notify():
     today = date.today().isoformat()
     now = datetime.now()
-    missed_records = [h for h in st.session_state.history if h["date"] == today and not h.get("taken", False)]
-    scheduled_missed = []
-    for med in st.session_state.medicines:
-        try:
-            hh, mm = map(int, med["sched_time"].split(":"))
-        except Exception:
-            continue
-        sched_dt = datetime.combine(date.today(), datetime.min.time()) + timedelta(hours=hh, minutes=mm)
-        rec = next((h for h in st.session_state.history if h["date"] == today and h["name"] == med["name"] and h["sched_time"] == med["sched_time"]), None)
-        if sched_dt < now and not rec:
-            scheduled_missed.append(med)
-    total_missed = len(missed_records) + len(scheduled_missed)
+    now_mins = now.hour * 60 + now.minute
+    hist = history_frame()
+    today_hist = hist[hist["date"] == pd.Timestamp(today)]
+    missed_count = int((~today_hist["taken"]).sum())
+    recorded = set(zip(today_hist["name"], today_hist["sched_time"]))
+    scheduled_missed = [m for m in st.session_state.medicines
+                        if m["sched_mins"] is not None and (m["name"], m["sched_time"]) not in recorded
+                        and m["sched_mins"] < now_mins]
+    total_missed = missed_count + len(scheduled_missed)
     if total_missed > 0:
         st.warning(f"You have {total_missed} missed dose(s) today.")
         if st.button("Send reminder (mock)"):
@@ -304,18 +522,19 @@ def import_medicines_from_csv(uploaded_file):
         st.error("CSV must contain at least 'name' and 'sched_time' columns.")
         return
     df.columns = [c.lower() for c in df.columns]
-    added = 0
-    for _, row in df.iterrows():
-        nm = str(row.get("name","")).strip()
-        stime = str(row.get("sched_time","")).strip()
-        notes = str(row.get("notes","")).strip() if "notes" in df.columns else ""
-        try:
-            datetime.strptime(stime, "%H:%M")
-        except Exception:
-            continue
-        add_medicine(nm, stime, notes)
-        added += 1
+    names = df["name"].fillna("").astype(str).str.strip()
+    # accept H:M / H:MM / HH:M like strptime did, and normalise both fields to two digits
+    parts = df["sched_time"].fillna("").astype(str).str.strip().str.extract(r"^(\d{1,2}):(\d{1,2})$")
+    times = parts[0].str.zfill(2) + ":" + parts[1].str.zfill(2)
+    notes = df["notes"].fillna("").astype(str).str.strip() if "notes" in df.columns else ""
+    valid = names.ne("") & times.str.match(_HHMM_RE.pattern, na=False)
+    new = pd.DataFrame({"name": names, "sched_time": times, "notes": notes})[valid]
+    for rec in new.to_dict("records"):
+        _add_medicine_nosave(rec["name"], rec["sched_time"], rec["notes"], keep_sorted=False)
+    added = len(new)
     if added:
+        rebuild_med_keys()
+        save_state_to_disk()
         st.success(f"Imported {added} medicines.")
     else:
         st.info("No valid medicines were imported (check time format HH:MM).")
@@ -323,6 +542,24 @@ def import_medicines_from_csv(uploaded_file):
 # -------------------------
 # Simple plant image generator (safe integers)
 # -------------------------
+# Leaf polygons as (x, y, dx): x/y are fractions of the image size, dx a pixel offset
+# from the stem so the leaves stay attached at any size.
+_LEAF_POLY_TEMPLATE = [
+    [(0.5, 0.36, -6), (0.32, 0.28, 0), (0.30, 0.36, 0), (0.5, 0.42, -6)],
+    [(0.5, 0.36, +6), (0.68, 0.28, 0), (0.70, 0.36, 0), (0.5, 0.42, +6)],
+    [(0.5, 0.52, -6), (0.36, 0.48, 0), (0.34, 0.56, 0), (0.5, 0.60, -6)],
+    [(0.5, 0.52, +6), (0.64, 0.48, 0), (0.66, 0.56, 0), (0.5, 0.60, +6)],
+    [(0.5, 0.28, -6), (0.40, 0.24, 0), (0.39, 0.30, 0), (0.5, 0.32, -6)],
+    [(0.5, 0.28, +6), (0.60, 0.24, 0), (0.61, 0.30, 0), (0.5, 0.32, +6)],
+]
+# Decorative dots as ((x0, y0, x1, y1), fill), in fractions of the image size.
+_DOT_TEMPLATE = [
+    ((0.20, 0.18, 0.27, 0.25), (200,245,220)),
+    ((0.72, 0.16, 0.79, 0.23), (200,245,220)),
+    ((0.17, 0.74, 0.24, 0.80), (255,230,230)),
+]
+
+@st.cache_resource(show_spinner=False)
 def generate_plant_image(size=260, leaf_color=(34,139,86)):
     W = int(size); H = int(size)
     im = Image.new("RGBA", (W, H), (255,255,255,0))
@@ -330,21 +567,21 @@ def generate_plant_image(size=260, leaf_color=(34,139,86)):
     draw.ellipse([(int(W*0.05), int(H*0.05)), (int(W*0.95), int(H*0.95))], fill=(240,255,250,255))
     stem_x = int(W*0.5); stem_top = int(H*0.22); stem_bottom = int(H*0.72)
     draw.line([(stem_x, stem_top), (stem_x, stem_bottom)], fill=(70,110,60), width=6)
-    leaves = [
-        [(int(W*0.5)-6, int(H*0.36)), (int(W*0.32), int(H*0.28)), (int(W*0.30), int(H*0.36)), (int(W*0.5)-6, int(H*0.42))],
-        [(int(W*0.5)+6, int(H*0.36)), (int(W*0.68), int(H*0.28)), (int(W*0.70), int(H*0.36)), (int(W*0.5)+6, int(H*0.42))],
-        [(int(W*0.5)-6, int(H*0.52)), (int(W*0.36), int(H*0.48)), (int(W*0.34), int(H*0.56)), (int(W*0.5)-6, int(H*0.60))],
-        [(int(W*0.5)+6, int(H*0.52)), (int(W*0.64), int(H*0.48)), (int(W*0.66), int(H*0.56)), (int(W*0.5)+6, int(H*0.60))],
-        [(int(W*0.5)-6, int(H*0.28)), (int(W*0.40), int(H*0.24)), (int(W*0.39), int(H*0.30)), (int(W*0.5)-6, int(H*0.32))],
-        [(int(W*0.5)+6, int(H*0.28)), (int(W*0.60), int(H*0.24)), (int(W*0.61), int(H*0.30)), (int(W*0.5)+6, int(H*0.32))],
-    ]
-    for poly in leaves:
-        draw.polygon(poly, fill=leaf_color + (255,), outline=(int(leaf_color[0]*0.6), int(leaf_color[1]*0.6), int(leaf_color[2]*0.6)))
-    draw.ellipse([(int(W*0.20), int(H*0.18)), (int(W*0.27), int(H*0.25))], fill=(200,245,220))
-    draw.ellipse([(int(W*0.72), int(H*0.16)), (int(W*0.79), int(H*0.23))], fill=(200,245,220))
-    draw.ellipse([(int(W*0.17), int(H*0.74)), (int(W*0.24), int(H*0.80))], fill=(255,230,230))
+    fill = leaf_color + (255,)
+    outline = tuple(int(c*0.6) for c in leaf_color)
+    for poly in _LEAF_POLY_TEMPLATE:
+        draw.polygon([(int(x*W) + dx, int(y*H)) for x, y, dx in poly], fill=fill, outline=outline)
+    for (x0, y0, x1, y1), dot_fill in _DOT_TEMPLATE:
+        draw.ellipse([(int(W*x0), int(H*y0)), (int(W*x1), int(H*y1))], fill=dot_fill)
     return im.convert("RGB")
 
+@st.cache_resource(show_spinner=False)
+def plant_data_uri(size=120, leaf_color=(200,200,200)):
+    """PNG data URI of the plant image, for embedding in HTML cards."""
+    buf = io.BytesIO()
+    generate_plant_image(size, leaf_color=leaf_color).save(buf, format="PNG")
+    return f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode()}"
+
 # -------------------------
 # USER LOGIN UI (top)
 # -------------------------
@@ -415,50 +652,40 @@ with st.sidebar:
         for med in st.session_state.medicines:
             cols = st.columns([3,1])
             cols[0].markdown(f"**{med['name']}** — {friendly_time_str(med['sched_time'])}")
-            if cols[1].button("❌", key=f"del_{med['id']}"):
-                delete_medicine(med["id"])
-                safe_rerun()
+            cols[1].button("❌", key=f"del_{med['id']}", on_click=delete_medicine, args=(med["id"],))
     else:
         st.info("No medicines yet. Add one above or import a CSV.")
 
 # -------------------------
 # Main: Today's checklist + history
 # -------------------------
-left, right = st.columns([2,1])
-
-with left:
+def render_checklist():
     st.subheader("Today's Checklist")
     now = datetime.now()
     now_mins = now.hour * 60 + now.minute
     if st.session_state.medicines:
-        for med in sorted(st.session_state.medicines, key=lambda x: x.get("sched_time","")):
+        for med in medicines_by_schedule():
             sched = med["sched_time"]
-            try:
-                hh, mm = map(int, sched.split(":"))
-                sched_mins = hh*60 + mm
-            except Exception:
-                sched_mins = 0
+            sched_mins = med["sched_mins"]
             today_str = date.today().isoformat()
-            rec = next((h for h in st.session_state.history if h["date"]==today_str and h["name"]==med["name"] and h["sched_time"]==sched), None)
+            rec = st.session_state.history_index.get((today_str, med["name"], sched))
             if rec:
                 if rec["taken"]:
                     st.markdown(f"✅ **{med['name']}** — {friendly_time_str(sched)} (Taken at {rec['taken_time']})")
                 else:
                     st.markdown(f"🔴 **{med['name']}** — {friendly_time_str(sched)} (Missed)")
             else:
-                if now_mins < sched_mins - 15:
+                if sched_mins is None:
+                    st.markdown(f"⚪ **{med['name']}** — {sched} (Time not recognised)")
+                elif now_mins < sched_mins - 15:
                     st.markdown(f"🟡 **{med['name']}** — {friendly_time_str(sched)} (Upcoming)")
                 elif sched_mins - 15 <= now_mins <= sched_mins + 30:
                     st.markdown(f"⚪ **{med['name']}** — {friendly_time_str(sched)} (Due now/soon)")
                 else:
                     st.markdown(f"🔴 **{med['name']}** — {friendly_time_str(sched)} (Missed)")
             c1,c2,c3 = st.columns([1,1,4])
-            if c1.button("Taken", key=f"take_{med['id']}"):
-                mark_taken(med["name"], sched)
-                safe_rerun()
-            if c2.button("Missed", key=f"miss_{med['id']}"):
-                mark_missed(med["name"], sched)
-                safe_rerun()
+            c1.button("Taken", key=f"take_{med['id']}", on_click=mark_taken, args=(med["name"], sched))
+            c2.button("Missed", key=f"miss_{med['id']}", on_click=mark_missed, args=(med["name"], sched))
             if med.get("notes"):
                 st.caption(f"Notes: {med['notes']}")
     else:
@@ -467,56 +694,39 @@ with left:
     st.markdown("---")
     st.subheader("History (Recent First)")
     if st.session_state.history:
-        df = pd.DataFrame(sorted(st.session_state.history, key=lambda x: (x["date"], x["sched_time"]), reverse=True))
-        st.dataframe(df, use_container_width=True)
+        st.dataframe(history_table(), use_container_width=True)
     else:
         st.info("No history yet. Mark doses to build records.")
 
 # -------------------------
 # Right column: adherence, actions, encouragement, next-dose, chart, notifications
 # -------------------------
-with right:
+def render_adherence_panel():
     st.subheader("Adherence & Actions")
 
-    # weekly adherence calculation (same logic as earlier)
-    adherence = 100.0
-    if st.session_state.medicines:
-        scheduled = st.session_state.medicines
-        today_d = date.today()
-        start = today_d - timedelta(days=6)
-        days = [(start + timedelta(days=i)).isoformat() for i in range(7)]
-        scores = []
-        for d in days:
-            records = [h for h in st.session_state.history if h["date"]==d]
-            taken_count = 0
-            for s in scheduled:
-                found = any(r["name"]==s["name"] and r["sched_time"]==s["sched_time"] and r["taken"] for r in records)
-                if found:
-                    taken_count += 1
-            scores.append(taken_count/len(scheduled))
-        adherence = round(sum(scores)/len(scores) * 100, 1)
+    # weekly adherence: mean of the same per-day series the chart uses
+    adherence = round(float(daily_adherence_series(days_back=7).mean()), 1)
     st.metric("Weekly adherence", f"{adherence}%")
     st.progress(min(max(int(adherence),0),100))
 
     # Export CSV
-    csv_str = pd.DataFrame(st.session_state.history).to_csv(index=False)
+    csv_bytes = history_csv()
     try:
-        st.download_button("Export CSV", csv_str, file_name="adhera_history.csv", mime="text/csv")
+        st.download_button("Export CSV", csv_bytes, file_name="adhera_history.csv", mime="text/csv")
     except Exception:
-        st.markdown(f'<a href="data:file/csv;base64,{base64.b64encode(csv_str.encode()).decode()}" download="adhera_history.csv">Download CSV</a>', unsafe_allow_html=True)
+        st.markdown(f'<a href="data:file/csv;base64,{base64.b64encode(csv_bytes).decode()}" download="adhera_history.csv">Download CSV</a>', unsafe_allow_html=True)
 
     # Clear today's records
     if st.button("Clear today's records"):
         today = date.today().isoformat()
         st.session_state.history = [h for h in st.session_state.history if h["date"] != today]
-        save_state_to_disk()
+        rebuild_history_index()
+        save_history_to_disk()
         safe_rerun()
 
     st.markdown("---")
     # Encouragement card (ACCENT is white as requested)
-    badge_img = generate_plant_image(120, leaf_color=(200,200,200))
-    buf = io.BytesIO(); badge_img.save(buf, format="PNG"); b64 = base64.b64encode(buf.getvalue()).decode()
-    badge_datauri = f"data:image/png;base64,{b64}"
+    badge_datauri = plant_data_uri(120, leaf_color=(200,200,200))
 
     if adherence >= 90:
         title = "Outstanding — keep it up!"
@@ -555,10 +765,8 @@ with right:
         st.markdown(f"**Next dose:** {med_next['name']} — {friendly_time_str(med_next['sched_time'])}")
         st.markdown(f"**When:** {dt_str} — **{delta_txt}**")
         if dt_next.date() == date.today():
-            if st.button("Mark next as taken"):
-                mark_taken(med_next["name"], med_next["sched_time"])
+            if st.button("Mark next as taken", on_click=mark_taken, args=(med_next["name"], med_next["sched_time"])):
                 st.success("Marked as taken.")
-                safe_rerun()
         st.markdown("</div>", unsafe_allow_html=True)
     else:
         st.info("No scheduled medicines to compute the next dose.")
@@ -571,6 +779,20 @@ with right:
     # Notification simulation
     check_and_notify()
 
+# -------------------------
+# Main area: everything that reads the history reruns together
+# -------------------------
+@_fragment
+def render_main():
+    """Checklist, history and adherence panel; Taken/Missed clicks rerun only this fragment."""
+    left, right = st.columns([2,1])
+    with left:
+        render_checklist()
+    with right:
+        render_adherence_panel()
+
+render_main()
+
 # -------------------------
 # Admin options (danger) - optional
 # -------------------------
@@ -579,12 +801,16 @@ if st.checkbox("Show admin options"):
     if st.button("Reset ALL data (delete medicines & history)"):
         st.session_state.medicines = []
         st.session_state.history = []
+        st.session_state.history_index = {}
+        st.session_state.med_keys = []
+        st.session_state.med_by_id = {}
         st.session_state.next_id = 1
+        _bump_history_version()
         # remove user file if set
         try:
-            df = get_data_file()
-            if df.exists():
-                df.unlink()
+            for df in (get_data_file(), get_history_file()):
+                if df.exists():
+                    df.unlink()
         except Exception:
             pass
         save_state_to_disk()